@@ -1,12 +1,18 @@
 import argparse
+import atexit
 import collections
+import csv
+import functools
 import json
+import multiprocessing
 import threading
 import time
 import hashlib
 import base64
+import shutil
+import tempfile
+from queue import Empty
 
-import pandas as pd
 from flask import Flask, send_from_directory, request
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
@@ -14,69 +20,121 @@ from kafka import KafkaConsumer
 from kafka import TopicPartition
 from kafka.errors import NoBrokersAvailable
 
+try:
+    import orjson
+
+    def loads_message(value: bytes):
+        return orjson.loads(value)
+except ImportError:
+    def loads_message(value: bytes):
+        return json.loads(value.decode('utf-8'))
+
 # The following kafka topics are accessible by merchants and the management UI
 topics = ['addOffer', 'buyOffer', 'profit', 'updateOffer', 'updates', 'salesPerMinutes',
           'cumulativeAmountBasedMarketshare', 'cumulativeRevenueBasedMarketshare',
           'marketSituation', 'revenuePerMinute', 'revenuePerHour', 'profitPerMinute', 'inventory_level']
+# Every topic is read from its only partition
+topic_partitions = {topic: TopicPartition(topic, 0) for topic in topics}
+# Templates of the JSON objects sent to the clients. The JSON-encoded Kafka message is inserted
+# as value without decoding and encoding it again.
+envelope_formats = {topic: '{"topic":"' + topic + '","timestamp":%d,"value":%s}' for topic in topics}
 
 
 class KafkaHandler:
     def __init__(self, kafka_endpoint: str, socketio: SocketIO):
-        self.consumer = KafkaConsumer(bootstrap_servers=kafka_endpoint)
         self.socketio = socketio
+        # JSON-encoded messages per topic
         self.dumps = {}
-        end_offset = {}
+        # JSON-encoded snapshots of self.dumps, rebuilt lazily after new messages arrived
+        self.dumps_cached = {}
+        self.dumps_lock = threading.Lock()
 
         for topic in topics:
             self.dumps[topic] = collections.deque(maxlen=100)
-            current_partition = TopicPartition(topic, 0)
-            self.consumer.assign([current_partition])
-            self.consumer.seek_to_end()
-            end_offset[topic] = self.consumer.position(current_partition)
+        # bound once, so that emitting a batch does not resolve the topic and namespace each time
+        self.emitters = {topic: functools.partial(socketio.emit, topic, namespace='/') for topic in topics}
 
-        topic_partitions = [TopicPartition(topic, 0) for topic in topics]
-        self.consumer.assign(topic_partitions)
-        for topic in topics:
-            self.consumer.seek(TopicPartition(topic, 0), max(0, end_offset[topic] - 100))
+        # Kafka messages are consumed and encoded in a separate process, so that decoding does not
+        # compete with the web server for the GIL.
+        self.kafka_endpoint = kafka_endpoint
+        self.start_consumer_process()
 
         self.thread = threading.Thread(target=self.run)
         self.thread.daemon = True  # Demonize thread
         self.thread.start()  # Start the execution
 
+    def start_consumer_process(self):
+        # Every consumer process gets a new queue: a process that was killed while writing may have
+        # left the previous one corrupted. The queue is bounded to apply backpressure.
+        self.queue = multiprocessing.Queue(maxsize=100)
+        self.consumer_process = multiprocessing.Process(target=consume_messages,
+                                                        args=(self.kafka_endpoint, self.queue))
+        self.consumer_process.daemon = True
+        self.consumer_process.start()
+
+    def restart_consumer_process(self):
+        print('consumer process is not running (exit code', self.consumer_process.exitcode, ') - restarting')
+        # the new consumer process sends the last 100 messages of each topic again
+        with self.dumps_lock:
+            for dump in self.dumps.values():
+                dump.clear()
+            self.dumps_cached.clear()
+        self.start_consumer_process()
+
     def run(self):
-        for msg in self.consumer:
+        while True:
             try:
-                msg_json = json.loads(msg.value.decode('utf-8'))
-                if 'http_code' in msg_json and msg_json['http_code'] != 200:
-                    continue
-
-                output = {
-                    "topic": msg.topic,
-                    "timestamp": msg.timestamp,
-                    "value": msg_json
-                }
-                output_json = json.dumps(output)
-                self.dumps[str(msg.topic)].append(output)
-
-                self.socketio.emit(str(msg.topic), output_json, namespace='/')
+                outputs_by_topic = self.queue.get(timeout=5)
+            except Empty:
+                outputs_by_topic = None
             except Exception as e:
-                print('error emit msg', e)
-
-        self.consumer.close()
+                print('error reading from consumer process', e)
+                outputs_by_topic = None
+            if outputs_by_topic is None:
+                if not self.consumer_process.is_alive():
+                    try:
+                        self.restart_consumer_process()
+                    except Exception as e:
+                        # retried on the next timeout, since the process is still not alive
+                        print('error restarting consumer process', e)
+                continue
+
+            with self.dumps_lock:
+                for topic, outputs in outputs_by_topic.items():
+                    self.dumps[topic].extend(outputs)
+                    self.dumps_cached.pop(topic, None)
+
+            # One emit per topic and poll instead of one emit per message
+            for topic, outputs in outputs_by_topic.items():
+                try:
+                    self.emitters[topic](json_list(outputs))
+                except Exception as e:
+                    print('error emit msg', e)
 
     def on_connect(self):
-        if self.dumps:
+        with self.dumps_lock:
             for msg_topic in self.dumps:
-                messages = list(self.dumps[msg_topic])
-                emit(msg_topic, messages, namespace='/')
+                if msg_topic not in self.dumps_cached:
+                    self.dumps_cached[msg_topic] = json_list(self.dumps[msg_topic])
+            snapshots = list(self.dumps_cached.items())
+
+        for msg_topic, messages in snapshots:
+            emit(msg_topic, messages, namespace='/')
 
     def status(self):
         status_dict = {}
-        for topic in self.dumps:
-            status_dict[topic] = {
-                'messages': len(self.dumps[topic]),
-                'last_message': self.dumps[topic][-1] if self.dumps[topic] else ''
-            }
+        with self.dumps_lock:
+            for topic in self.dumps:
+                last_message = ''
+                if self.dumps[topic]:
+                    try:
+                        last_message = json.loads(self.dumps[topic][-1])
+                    except ValueError:
+                        last_message = self.dumps[topic][-1]
+                status_dict[topic] = {
+                    'messages': len(self.dumps[topic]),
+                    'last_message': last_message
+                }
         return json.dumps(status_dict)
 
 
@@ -87,6 +145,10 @@ class KafkaReverseProxy:
         self.socketio = SocketIO(self.app)
 
         self.kafka_endpoint = kafka_endpoint
+        # Idle export consumers, reused by later export requests and closed on shutdown
+        self.export_consumers = []
+        self.export_consumers_lock = threading.Lock()
+        atexit.register(self.close_export_consumers)
         self.kafka_handler = KafkaHandler(kafka_endpoint, self.socketio)
         self.register_routes()
 
@@ -106,9 +168,10 @@ class KafkaReverseProxy:
         if topic not in topics:
             return json.dumps({'error': 'unknown topic'})
 
+        consumer = None
         try:
-            consumer = KafkaConsumer(consumer_timeout_ms=1000, bootstrap_servers=self.kafka_endpoint)
-            topic_partition = TopicPartition(topic, 0)
+            consumer = self.acquire_export_consumer()
+            topic_partition = topic_partitions[topic]
             consumer.assign([topic_partition])
 
             consumer.seek_to_beginning()
@@ -117,7 +180,6 @@ class KafkaReverseProxy:
             consumer.seek_to_end()
             end_offset = consumer.position(topic_partition)
 
-            msgs = []
             '''
             Assumption: message offsets are continuous.
             Start and end can be anywhere, end - start needs to match the amount of messages.
@@ -126,37 +188,49 @@ class KafkaReverseProxy:
             max_messages = 10 ** 5
             offset = max(start_offset, end_offset - max_messages)
             consumer.seek(topic_partition, offset)
-            for msg in consumer:
-                '''
-                Don't handle steadily incoming new messages
-                only iterate to last messages when requested
-                '''
-                if offset >= end_offset:
-                    break
-                offset += 1
-                try:
-                    msg_json = json.loads(msg.value.decode('utf-8'))
-                    # filtering on messages that can be filtered on merchant_id
-                    if 'merchant_id' not in msg_json or msg_json['merchant_id'] == merchant_id:
-                        msgs.append(msg_json)
-                except ValueError as e:
-                    print('ValueError', e, 'in message:\n', msg.value)
-            consumer.close()
+            msgs = merchant_messages(consumer, offset, end_offset, merchant_id)
 
             if topic == 'marketSituation':
-                df = market_situation_shaper(msgs)
+                rows = market_situation_shaper(msgs)
             else:
-                df = pd.DataFrame(msgs)
+                rows = msgs
 
             filename = topic + '_' + str(int(time.time()))
             filepath = 'data/' + filename + '.csv'
-            df.to_csv(filepath, index=False)
+            write_csv(rows, filepath)
+            self.release_export_consumer(consumer)
             response = {'url': filepath}
         except Exception as e:
+            # do not reuse a consumer that may be broken
+            if consumer is not None:
+                consumer.close()
             response = {'error': 'failed with: ' + str(e)}
 
         return json.dumps(response)
 
+    def acquire_export_consumer(self) -> KafkaConsumer:
+        with self.export_consumers_lock:
+            if self.export_consumers:
+                return self.export_consumers.pop()
+        return KafkaConsumer(consumer_timeout_ms=1000, fetch_max_wait_ms=100, check_crcs=False,
+                             bootstrap_servers=self.kafka_endpoint)
+
+    def release_export_consumer(self, consumer: KafkaConsumer):
+        """
+        Keeps the consumer for the next export, unless enough idle consumers are kept already.
+        """
+        with self.export_consumers_lock:
+            if len(self.export_consumers) < 4:
+                self.export_consumers.append(consumer)
+                return
+        consumer.close()
+
+    def close_export_consumers(self):
+        with self.export_consumers_lock:
+            consumers, self.export_consumers = self.export_consumers, []
+        for consumer in consumers:
+            consumer.close()
+
     @staticmethod
     def get_topics():
         return json.dumps(topics)
@@ -166,9 +240,105 @@ class KafkaReverseProxy:
         return send_from_directory('data', path, as_attachment=True)
 
 
+def consume_messages(kafka_endpoint: str, queue: multiprocessing.Queue) -> None:
+    """
+    Tails all topics, starting with the last 100 messages of each, and puts the JSON-encoded
+    messages of every poll into the queue, grouped by topic. Runs in the consumer process.
+    """
+    # The broker answers a fetch once 16 KiB are available or after at most 200 ms. This batches
+    # busy topics while bounding the delay of live updates on quiet ones. Larger partition fetches
+    # and socket buffers let bursts arrive in a single round trip. Offsets are never committed
+    # because the consumer always starts from the latest messages.
+    # CRC checks are skipped: kafka-python computes them in pure Python for every record and
+    # the brokers run in the same trusted network, where TCP already protects against corruption.
+    consumer = KafkaConsumer(bootstrap_servers=kafka_endpoint,
+                             fetch_min_bytes=16 * 1024,
+                             fetch_max_wait_ms=200,
+                             max_partition_fetch_bytes=4 * 1024 * 1024,
+                             receive_buffer_bytes=1024 * 1024,
+                             max_poll_records=500,
+                             enable_auto_commit=False,
+                             check_crcs=False)
+
+    consumer.assign(list(topic_partitions.values()))
+    end_offsets = consumer.end_offsets(list(topic_partitions.values()))
+    for topic_partition in topic_partitions.values():
+        consumer.seek(topic_partition, max(0, end_offsets[topic_partition] - 100))
+
+    while True:
+        try:
+            batches = consumer.poll(timeout_ms=500)
+        except Exception as e:
+            print('error polling kafka', e)
+            time.sleep(1)
+            continue
+        outputs_by_topic = collections.defaultdict(list)
+        for topic_partition, records in batches.items():
+            # all records of a partition batch belong to the same topic
+            topic_envelope = envelope_formats[topic_partition.topic]
+            topic_outputs = []
+            append = topic_outputs.append
+            for msg in records:
+                try:
+                    output = forwarded_message(topic_envelope, msg.timestamp, msg.value)
+                    if output is not None:
+                        append(output)
+                except Exception as e:
+                    print('error processing msg', e)
+            if topic_outputs:
+                outputs_by_topic[topic_partition.topic].extend(topic_outputs)
+
+        if outputs_by_topic:
+            queue.put(outputs_by_topic)
+
+
+def json_list(encoded_items) -> str:
+    """
+    Joins already JSON-encoded items into a JSON list without decoding them again.
+    """
+    return '[' + ','.join(encoded_items) + ']'
+
+
+def forwarded_message(topic_envelope: str, timestamp: int, value: bytes):
+    """
+    Returns the JSON object that is sent to the clients for a Kafka message, or None for messages
+    that are not forwarded, i.e. empty messages and failed requests. The value is inserted into the
+    envelope without encoding it again, but it is parsed to make sure that only valid JSON is
+    forwarded. Raises ValueError otherwise.
+    """
+    # tombstones and empty records carry no message
+    if not value:
+        return None
+    msg_json = loads_message(value)
+    if isinstance(msg_json, dict) and 'http_code' in msg_json and msg_json['http_code'] != 200:
+        return None
+    return topic_envelope % (timestamp, value.decode('utf-8'))
+
+
+def merchant_messages(consumer: KafkaConsumer, offset: int, end_offset: int, merchant_id: str):
+    """
+    Yields the decoded messages from offset up to end_offset that are visible to the given merchant.
+    """
+    for msg in consumer:
+        '''
+        Don't handle steadily incoming new messages
+        only iterate to last messages when requested
+        '''
+        if offset >= end_offset:
+            break
+        offset += 1
+        try:
+            msg_json = loads_message(msg.value)
+            # filtering on messages that can be filtered on merchant_id
+            if 'merchant_id' not in msg_json or msg_json['merchant_id'] == merchant_id:
+                yield msg_json
+        except ValueError as e:
+            print('ValueError', e, 'in message:\n', msg.value)
+
+
 def market_situation_shaper(list_of_msgs):
     """
-        Returns pd.DataFrame Table with columns:
+        Yields one row per offer with columns:
             timestamp
             merchant_id
             product_id
@@ -181,20 +351,75 @@ def market_situation_shaper(list_of_msgs):
             amount
             offer_id
             uid
+            triggering_merchant_id
     """
     # snapshot timestamp needs to be injected into the offer object
     # also the triggering merchant
-    expanded_offers = []
     for situation in list_of_msgs:
         for offer in situation['offers']:
-            offer['timestamp'] = situation['timestamp']
+            row = flatten(offer)
+            row['timestamp'] = situation['timestamp']
             if 'merchant_id' in situation:
-                offer['triggering_merchant_id'] = situation['merchant_id']
-            expanded_offers.append(offer)
-    return pd.DataFrame(expanded_offers)
+                row['triggering_merchant_id'] = situation['merchant_id']
+            yield row
+
+
+def flatten(nested: dict, prefix: str = '') -> dict:
+    """
+    Flattens nested dictionaries, e.g. {'shipping_time': {'prime': 1}} becomes {'shipping_time_prime': 1}.
+    """
+    flat = {}
+    for key, value in nested.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '_'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def write_csv(rows, filepath: str) -> None:
+    """
+    Streams dictionaries into a CSV file without holding all rows in memory.
+    Columns are sorted by name, like pandas did for lists of dictionaries. Rows are buffered
+    in a temporary file because the header is only known after the last row.
+    """
+    buffer_size = 2 ** 20
+    columns = []
+    known_columns = set()
+    initial_columns = None
+    with tempfile.TemporaryFile(mode='w+', newline='', buffering=buffer_size) as body:
+        body_writer = csv.writer(body, lineterminator='\n')
+        for row in rows:
+            # the subset check runs in C; most rows add no new columns
+            if not known_columns.issuperset(row.keys()):
+                for key in row:
+                    if key not in known_columns:
+                        known_columns.add(key)
+                        columns.append(key)
+            if initial_columns is None:
+                initial_columns = len(columns)
+            body_writer.writerow([row.get(column) for column in columns])
+
+        header = sorted(columns)
+        body.seek(0)
+        with open(filepath, 'w', newline='', buffering=buffer_size) as file:
+            file_writer = csv.writer(file, lineterminator='\n')
+            file_writer.writerow(header)
+            if initial_columns == len(columns) and header == columns:
+                shutil.copyfileobj(body, file, buffer_size)
+            else:
+                # body rows are in order of first appearance and rows written before a column
+                # appeared are shorter than the header
+                positions = {column: position for position, column in enumerate(columns)}
+                order = [positions[column] for column in header]
+                for body_row in csv.reader(body):
+                    body_row.extend([''] * (len(columns) - len(body_row)))
+                    file_writer.writerow([body_row[position] for position in order])
 
 
+@functools.lru_cache(maxsize=1024)
 def calculate_id(token: str) -> str:
+    # hashlib.sha256 is backed by OpenSSL, which uses the CPU's SHA extensions when available
     return base64.b64encode(hashlib.sha256(token.encode('utf-8')).digest()).decode('utf-8')
 
 
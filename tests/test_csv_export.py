@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from LoggerApp import market_situation_shaper, write_csv
+
+
+class WriteCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'export.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, rows) -> str:
+        write_csv(iter(rows), self.filepath)
+        with open(self.filepath, newline='') as file:
+            return file.read()
+
+    def test_header_is_sorted_and_rows_follow_it(self):
+        self.assertEqual(self.export([{'b': 1, 'a': 'x'}, {'b': 2, 'a': 'y'}]), 'a,b\nx,1\ny,2\n')
+
+    def test_column_appearing_mid_stream_pads_earlier_rows(self):
+        rows = [{'b': 1, 'a': 'x'}, {'a': 2, 'c': 'z'}, {'b': 3}]
+        self.assertEqual(self.export(rows), 'a,b,c\nx,1,\n2,,z\n,3,\n')
+
+    def test_empty_rows(self):
+        self.assertEqual(self.export([{'a': 1, 'b': 2}, {}, {'a': 3, 'b': 4}]), 'a,b\n1,2\n,\n3,4\n')
+        self.assertEqual(self.export([{}, {'a': 1}]), 'a\n""\n1\n')
+
+    def test_none_is_written_as_empty_field(self):
+        self.assertEqual(self.export([{'a': 1, 'b': None}, {'a': 2, 'b': 'z'}]), 'a,b\n1,\n2,z\n')
+
+    def test_fields_are_quoted(self):
+        rows = [{'a': 'x,y', 'b': 'say "hi"', 'c': 'line1\nline2'}]
+        self.assertEqual(self.export(rows), 'a,b,c\n"x,y","say ""hi""","line1\nline2"\n')
+
+    def test_quoted_fields_survive_reordering(self):
+        rows = [{'b': 'line1\nline2'}, {'a': 'x,y'}]
+        self.assertEqual(self.export(rows), 'a,b\n,"line1\nline2"\n"x,y",\n')
+
+    def test_rows_in_header_order_are_copied(self):
+        with mock.patch('LoggerApp.shutil.copyfileobj', wraps=shutil.copyfileobj) as copyfileobj:
+            self.assertEqual(self.export([{'a': 1, 'b': 2}, {'a': 3}]), 'a,b\n1,2\n3,\n')
+        copyfileobj.assert_called_once()
+
+    def test_unordered_rows_are_not_copied(self):
+        with mock.patch('LoggerApp.shutil.copyfileobj', wraps=shutil.copyfileobj) as copyfileobj:
+            self.assertEqual(self.export([{'b': 1, 'a': 2}]), 'a,b\n2,1\n')
+        copyfileobj.assert_not_called()
+
+    def test_empty_export(self):
+        self.assertEqual(self.export([]), '\n')
+
+
+class MarketSituationShaperTest(unittest.TestCase):
+    def test_offers_are_flattened_and_annotated(self):
+        situations = [
+            {'timestamp': 't1', 'merchant_id': 'm1', 'offers': [
+                {'offer_id': 1, 'merchant_id': 'a', 'shipping_time': {'standard': 5, 'prime': 1}},
+                {'offer_id': 2, 'merchant_id': 'b', 'shipping_time': {'standard': 4, 'prime': 2}},
+            ]},
+            {'timestamp': 't2', 'offers': [
+                {'offer_id': 3, 'merchant_id': 'a', 'shipping_time': {'standard': 5, 'prime': 1}},
+            ]},
+            {'timestamp': 't3', 'offers': []},
+        ]
+        self.assertEqual(list(market_situation_shaper(situations)), [
+            {'offer_id': 1, 'merchant_id': 'a', 'shipping_time_standard': 5, 'shipping_time_prime': 1,
+             'timestamp': 't1', 'triggering_merchant_id': 'm1'},
+            {'offer_id': 2, 'merchant_id': 'b', 'shipping_time_standard': 4, 'shipping_time_prime': 2,
+             'timestamp': 't1', 'triggering_merchant_id': 'm1'},
+            {'offer_id': 3, 'merchant_id': 'a', 'shipping_time_standard': 5, 'shipping_time_prime': 1,
+             'timestamp': 't2'},
+        ])
+
+    def test_situation_timestamp_overrides_offer_timestamp(self):
+        situations = [{'timestamp': 't1', 'offers': [{'offer_id': 1, 'timestamp': 'old'}]}]
+        self.assertEqual(list(market_situation_shaper(situations)), [{'offer_id': 1, 'timestamp': 't1'}])
+
+    def test_offers_are_not_modified(self):
+        offer = {'offer_id': 1}
+        list(market_situation_shaper([{'timestamp': 't1', 'merchant_id': 'm1', 'offers': [offer]}]))
+        self.assertEqual(offer, {'offer_id': 1})
+
+    def test_shaped_rows_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(directory, 'marketSituation.csv')
+            situations = [
+                {'timestamp': 't1', 'offers': [{'offer_id': 1, 'price': 9.5}]},
+                {'timestamp': 't2', 'merchant_id': 'm1', 'offers': [{'offer_id': 2, 'price': 8}]},
+            ]
+            write_csv(market_situation_shaper(situations), filepath)
+            with open(filepath, newline='') as file:
+                self.assertEqual(file.read(), 'offer_id,price,timestamp,triggering_merchant_id\n'
+                                              '1,9.5,t1,\n'
+                                              '2,8,t2,m1\n')
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import collections
+import json
+import threading
+import unittest
+
+from LoggerApp import KafkaHandler, envelope_formats, forwarded_message
+
+
+class HttpCodeFilterTest(unittest.TestCase):
+    def is_forwarded(self, value: bytes) -> bool:
+        return forwarded_message(envelope_formats['updates'], 1, value) is not None
+
+    def test_message_without_http_code_is_forwarded(self):
+        self.assertTrue(self.is_forwarded(b'{"offer_id": 1, "price": 3.5}'))
+
+    def test_http_code_200_is_forwarded(self):
+        self.assertTrue(self.is_forwarded(b'{"http_code":200}'))
+        self.assertTrue(self.is_forwarded(b'{"http_code" :\n 200, "offer_id": 1}'))
+        self.assertTrue(self.is_forwarded(b'{"http_code": 200.0}'))
+
+    def test_other_http_codes_are_dropped(self):
+        for value in [b'{"http_code": 404}', b'{"http_code": 2001}', b'{"http_code": 200.5}',
+                      b'{"http_code": "200"}', b'{"http_code": null}', b'{"http_code": true}',
+                      b'{"http_code"' + b' ' * 32 + b': 500}']:
+            with self.subTest(value=value):
+                self.assertFalse(self.is_forwarded(value))
+
+    def test_string_value_does_not_hide_key(self):
+        self.assertFalse(self.is_forwarded(b'{"field": "http_code", "http_code": 500}'))
+        self.assertTrue(self.is_forwarded(b'{"field": "http_code", "http_code": 200}'))
+        self.assertTrue(self.is_forwarded(b'{"field": "http_code"}'))
+
+    def test_only_top_level_http_code_is_checked(self):
+        self.assertTrue(self.is_forwarded(b'{"response": {"http_code": 404}, "offer_id": 1}'))
+        self.assertFalse(self.is_forwarded(b'{"inner": {"http_code": 200}, "http_code": 500}'))
+        self.assertTrue(self.is_forwarded(b'[{"http_code": 500}]'))
+
+
+class ForwardedMessageTest(unittest.TestCase):
+    def forward(self, value: bytes):
+        return forwarded_message(envelope_formats['profit'], 5, value)
+
+    def test_valid_values_are_wrapped_unchanged(self):
+        self.assertEqual(self.forward(b'{"a": 1}'), '{"topic":"profit","timestamp":5,"value":{"a": 1}}')
+        self.assertEqual(json.loads(self.forward(b' [1, 2]\n'))['value'], [1, 2])
+        self.assertEqual(json.loads(self.forward(b'42'))['value'], 42)
+
+    def test_empty_values_are_skipped(self):
+        self.assertIsNone(self.forward(None))
+        self.assertIsNone(self.forward(b''))
+
+    def test_malformed_values_are_rejected(self):
+        for value in [b'{"a":1}}', b'{"a": }', b'{"a":1}{"b":2}', b'{"a":', b'  ', b'\xff']:
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, self.forward, value)
+
+
+class StatusTest(unittest.TestCase):
+    def test_undecodable_last_message_is_returned_as_it_is(self):
+        handler = KafkaHandler.__new__(KafkaHandler)
+        handler.dumps_lock = threading.Lock()
+        handler.dumps = {'profit': collections.deque(['{"a":1}}']), 'updates': collections.deque()}
+        status = json.loads(handler.status())
+        self.assertEqual(status['profit'], {'messages': 1, 'last_message': '{"a":1}}'})
+        self.assertEqual(status['updates'], {'messages': 0, 'last_message': ''})
+
+
+if __name__ == '__main__':
+    unittest.main()